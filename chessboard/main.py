@@ -10,13 +10,23 @@ from direct.showbase.ShowBase import ShowBase
 from panda3d.core import CollisionTraverser, CollisionNode
 from panda3d.core import CollisionHandlerQueue, CollisionRay
 from panda3d.core import AmbientLight, DirectionalLight, LightAttrib
-from panda3d.core import TextNode
+from panda3d.core import TextNode, NodePathCollection
 from panda3d.core import LPoint3, LVector3, BitMask32
 from direct.gui.OnscreenText import OnscreenText
 from direct.showbase.DirectObject import DirectObject
 from direct.task.Task import Task
 import sys
 
+import numpy as np
+
+# numba is optional. When it is installed the move generator below is compiled
+# to native code, otherwise it just runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 # First we define some constants for the colors
 BLACK = (0, 0, 0, 1)
 WHITE = (1, 1, 1, 1)
@@ -47,6 +57,52 @@ def SquareColor(i):
     else:
         return WHITE
 
+# The colors and positions of the squares never change, so we work them out
+# once here instead of recomputing them every frame. This is the same pattern
+# as SquareColor and SquarePos, done for the whole board at once
+_idx = np.arange(64)
+_is_white = ((_idx + (_idx // 8) % 2) % 2) == 0
+_SQUARE_COLOR_ARR = np.where(_is_white[:, None],
+                             np.array(WHITE, dtype=np.float32),
+                             np.array(BLACK, dtype=np.float32))
+_SQUARE_POS_ARR = np.stack([_idx % 8 - 3.5, _idx // 8 - 3.5, np.zeros(64)],
+                           axis=1).astype(np.float32)
+_SQUARE_COLORS = tuple(tuple(row) for row in _SQUARE_COLOR_ARR.tolist())
+_SQUARE_POS = tuple(LPoint3(*row) for row in _SQUARE_POS_ARR.tolist())
+
+# Works out every square a piece can move to from src and returns them as a
+# 64-bit mask, where bit i is set if square i is a valid move. board holds one
+# int8 per square: 0 when it is empty, otherwise the piece_id of the piece on
+# it, negated for a black piece. moves is an (N, 2) int8 array of the
+# directions the piece can move in, and limit says whether it only moves a
+# single step
+@njit(cache=True)
+def LegalMask(board, src, moves, limit):
+    side = board[src]
+    mask = np.uint64(0)
+    xSrc = src % 8
+    ySrc = src // 8
+    for k in range(moves.shape[0]):
+        dx = moves[k, 0]
+        dy = moves[k, 1]
+        x = xSrc + dx
+        y = ySrc + dy
+        # Walk along the direction until we fall off the board
+        while 0 <= x < 8 and 0 <= y < 8:
+            dst = x + y*8
+            occupant = board[dst]
+            # pieces can't move into the space occupied by a piece of their
+            # color, which is when both squares have the same sign. Check this
+            # first, since there is nothing more to do in this direction
+            if occupant * side > 0:
+                break
+            mask |= np.uint64(1) << np.uint64(dst)
+            # stop after one step, or when taking a piece
+            if limit or occupant != 0:
+                break
+            x += dx
+            y += dy
+    return mask
 
 
 class ChessboardDemo(ShowBase):
@@ -71,7 +127,11 @@ class ChessboardDemo(ShowBase):
         self.accept('escape', sys.exit)  # Escape quits
         self.disableMouse()  # Disble mouse camera control
         camera.setPosHpr(0, -12, 8, 0, -35, 0)  # Set the camera
+        # The camera only moves between turns, so we keep its transform to
+        # render around instead of asking for it every frame
+        self._camMat = camera.getMat(render)
         self.setupLights()  # Setup default lighting
+        self._debug = False  # Set to True to print every move to the console
 
         # Since we are using collision detection to do picking, we set it up like
         # any other collision detection system with a traverser and a handler
@@ -100,17 +160,15 @@ class ChessboardDemo(ShowBase):
         self.squareRoot = render.attachNewNode("squareRoot")
 
         # For each square
-        self.squares = [None for i in range(64)]
-        self.pieces = [None for i in range(64)]
+        self.squares = [None] * 64
+        self.pieces = [None] * 64
+        # Shadow of self.pieces that the move generator works on, see LegalMask
+        self._board = np.zeros(64, dtype=np.int8)
         # creates a 2d array for a easier time finding valid moves (for hummans)
-        print("\nThe 8x8 board:")
-        print("  1 | 2 | 3 | 4 | 5 | 6 | 7 | 8 |")
-        x = 0
-        self.board = [[8*i+j for j in range(8)] for i in range(8)]
-        for i in self.board:
-            for j in i:
-                print(j,end = " ")
-            print()
+        self.board = np.arange(64, dtype=np.int8).reshape(8, 8)
+        if self._debug:
+            print("\nThe 8x8 board:")
+            print(self.board)
         
         
         for i in range(64):
@@ -118,17 +176,17 @@ class ChessboardDemo(ShowBase):
             # polygon)
             self.squares[i] = loader.loadModel("models/square")
             self.squares[i].reparentTo(self.squareRoot)
-            self.squares[i].setPos(SquarePos(i))
-            self.squares[i].setColor(SquareColor(i))
+            self.squares[i].setPos(_SQUARE_POS[i])
+            self.squares[i].setColor(_SQUARE_COLORS[i])
             # Set the model itself to be collideable with the ray. If this model was
             # any more complex than a single polygon, you should set up a collision
             # sphere around it instead. But for single polygons this works
             # fine.
-            self.squares[i].find("**/polygon").node().setIntoCollideMask(
-                BitMask32.bit(1))
+            poly = self.squares[i].find("**/polygon").node()
+            poly.setIntoCollideMask(BitMask32.bit(1))
             # Set a tag on the square's node so we can look up what square this is
-            # later during the collision pass
-            self.squares[i].find("**/polygon").node().setTag('square', str(i))
+            # later during the collision pass. A python tag keeps it as an int
+            poly.setPythonTag('square', i)
 
             # We will use this variable as a pointer to whatever piece is currently
             # in this square
@@ -145,6 +203,7 @@ class ChessboardDemo(ShowBase):
             # load the black pawns
             self.pieces[i] = Pawn(i, PIECEBLACK)
             self.pieces[i].moves = [(0,-1),(1,-1),(-1,-1)]
+            self.pieces[i].moves_arr = -Pawn.moves_arr
         for i in range(8):
             # Load the special pieces for the front row and color them white
             self.pieces[i] = pieceOrder[i](i, WHITE)
@@ -154,11 +213,24 @@ class ChessboardDemo(ShowBase):
         # Keep track of whose turn it is:
         self.is_turn_white = True
         
-        # This will represent the index of the currently highlited square
-        self.hiSq = False
+        # This will represent the index of the currently highlited square, or -1
+        # if there isn't one
+        self.hiSq = -1
         # This wil represent the index of the square where currently dragged piece
-        # was grabbed from
-        self.dragging = False
+        # was grabbed from, or -1 if nothing is being dragged
+        self.dragging = -1
+        # The squares currently colored to show the dragged piece's valid moves
+        self._dirtySquares = set()
+        # The same squares, collected so they can all be colored in one call
+        self._validNPC = NodePathCollection()
+        # Bitmask of the squares the dragged piece can legally move to
+        self._dragMask = 0
+        # The square whose valid moves are painted on the board, or -1
+        self._dragMaskSrc = -1
+        # The mouse position of the last collision pass
+        self._lastMpos = None
+        # Reused every frame to hold the position of the dragged piece
+        self._dragScratch = LPoint3(0, 0, .5)
 
         # Start the task that handles the picking
         self.mouseTask = taskMgr.add(self.mouseTask, 'mouseTask')
@@ -171,10 +243,11 @@ class ChessboardDemo(ShowBase):
         self.pieces[fr] = self.pieces[to]
         self.pieces[to] = temp
         if self.pieces[fr] and (fr != to):
-            if type(self.pieces[fr]) == type(King(-100, WHITE)):
-                self.title = OnscreenText(text="Game over!",
-                                  style=1, fg=(1, 1, 1, 1), shadow=(0, 0, 0, 1),
-                                  pos=(0.3, 0.5), scale = .3)
+            if isinstance(self.pieces[fr], King):
+                # Reuse the title text rather than making a new one
+                self.title.setText("Game over!")
+                self.title.setPos(0.3, 0.5)
+                self.title.setScale(.3)
             
             # removes the piece
             self.pieces[fr].remove()
@@ -182,119 +255,79 @@ class ChessboardDemo(ShowBase):
             #self.pieces[fr].square = fr
             #self.pieces[fr].obj.setPos(SquarePos(fr))
             
+        # Keep the move generator's board in step with self.pieces
+        self._board[fr] = 0
         if self.pieces[to]:
             self.pieces[to].square = to
-            self.pieces[to].obj.setPos(SquarePos(to))
-    
-    def isPieceBetween(self, move, currentPos, targetPos):
-        piece_NOT_between = True
-        xCurrent = currentPos % 8
-        yCurrent = currentPos // 8
-        print(f"Index is [{currentPos}] target is {targetPos}")
-        currentPos += move[0] + move[1]*8
-        while currentPos != targetPos and currentPos>-1 and currentPos<64:
-            print(f"Index is {currentPos} target is: {targetPos}, adding: {move[0] + move[1]*8}")
-            if self.pieces[currentPos] != None:
-                # There is a piece between
-                piece_NOT_between = False
-            currentPos += move[0] + move[1]*8
-        return piece_NOT_between
-            
-            
+            self.pieces[to].obj.setPos(_SQUARE_POS[to])
+            self._board[to] = self.pieces[to].board_value
     
-    # is the position a valid move?
-    def isVaidMove(self, piece, currentPos, targetPos):
-        valid_move = False
-            
-        xCurrent = currentPos % 8
-        yCurrent = currentPos // 8
-        xTarget = targetPos % 8
-        yTarget = targetPos // 8
-        xDistance = xTarget - xCurrent
-        yDistance = yTarget - yCurrent
-        # Go through each direction a piece can move
-        for move in piece.moves:
-            # if the x distance is exactly equal to the the x move:
-            if (xDistance == move[0]):
-                # if the y distance is exactly equal to the the y move:
-                if (yDistance == move[1]):
-                    # it is a valid move
-                    valid_move = True
-                # else if the player is trying to move diagonally in the y direction
-                # and the piece can move more than one space at a time:
-                elif piece.limit == False and move[1] != 0 and yDistance != 0:
-                    # Checks if the ratio of x and y is valid
-                    if (yDistance % move[1] == 0 and yDistance // move[1] > 0):
-                        if xDistance/yDistance == move[0]/move[1]:
-                            # it is a valid move
-                            valid_move = True
-            # else if the player is trying to move more than one space
-            # and the piece can move more than one space at a time:
-            elif piece.limit == False and move[0] != 0:
-                if (xDistance % move[0] == 0 and xDistance // move[0] > 0):
-                    # if the y distance is exactly equal to the the y move:
-                    if (yDistance == move[1]):
-                        # Checks if the ratio of x and y is valid
-                        if yDistance/xDistance == move[1]/move[0]:
-                            # it is a valid move
-                            valid_move = True
-                    # else if the player is trying to move diagonally in the y direction
-                    elif move[1] != 0 and yDistance != 0:
-                        if (yDistance % move[1] == 0 and yDistance // move[1] > 0):
-                            # Checks if the ratio of x and y is valid
-                            if xDistance/yDistance == move[0]/move[1]:
-                                # it is a valid move
-                                valid_move = True
-            # Checks if there is a piece between where it is moving each move
-            if valid_move == True and self.pieces[currentPos].limit == False:
-                valid_move = self.isPieceBetween(move, currentPos, targetPos)
-                break    # break here
-       
-        # pieces can't move into the space occupied by a piece of their color
-        if self.pieces[targetPos] != None:
-            if self.pieces[targetPos].white == piece.white:
-                valid_move = False
+    # Returns the mask of squares the piece on src can move to
+    def _legal_mask(self, piece, src):
+        return int(LegalMask(self._board, src, piece.moves_arr, piece.limit))
 
-        
-        return valid_move
-        
     def mouseTask(self, task):
         # This task deals with the highlighting and dragging based on the mouse
 
-        # First, clear the current highlight
-        if self.hiSq is not False:
-            for i in range(64):
-                self.squares[i].setColor(SquareColor(i))
-            self.hiSq = False
+        # Look these up once, they are used all over this function
+        squares = self.squares
+        pieces = self.pieces
+        colors = _SQUARE_COLORS
+        dirty = self._dirtySquares
+        dragging = self.dragging
+        mouseWatcherNode = self.mouseWatcherNode
+
+        # If nothing is being dragged and the mouse hasn't moved since the last
+        # collision pass, the current highlight is still right
+        if dragging < 0 and mouseWatcherNode.hasMouse():
+            mpos = mouseWatcherNode.getMouse()
+            if (mpos.getX(), mpos.getY()) == self._lastMpos:
+                return Task.cont
+
+        # First, clear the current highlight. A valid move square goes back to
+        # showing that it is a valid move
+        if self.hiSq >= 0:
+            i = self.hiSq
+            squares[i].setColor(VALID if i in dirty else colors[i])
+            self.hiSq = -1
 
         # Check to see if we can access the mouse. We need it to do anything
         # else
-        if self.mouseWatcherNode.hasMouse():
+        if mouseWatcherNode.hasMouse():
             # get the mouse position
-            mpos = self.mouseWatcherNode.getMouse()
+            mpos = mouseWatcherNode.getMouse()
 
             # Set the position of the ray based on the mouse position
             self.pickerRay.setFromLens(self.camNode, mpos.getX(), mpos.getY())
 
             # If we are dragging something, set the position of the object
             # to be at the appropriate point over the plane of the board
-            if self.dragging is not False:
+            if dragging >= 0:
                 # Gets the point described by pickerRay.getOrigin(), which is relative to
                 # camera, relative instead to render
-                nearPoint = render.getRelativePoint(
-                    camera, self.pickerRay.getOrigin())
+                origin = self._camMat.xformPoint(self.pickerRay.getOrigin())
                 # Same thing with the direction of the ray
-                nearVec = render.getRelativeVector(
-                    camera, self.pickerRay.getDirection())
-                self.pieces[self.dragging].obj.setPos(
-                    PointAtZ(.5, nearPoint, nearVec))
-
-
-            # Highlight valid moves:
-            if self.dragging is not False:
+                direction = self._camMat.xformVec(self.pickerRay.getDirection())
+                # Find where the ray crosses z = .5, the same math as PointAtZ
+                # written out here so we can reuse _dragScratch
+                inv_dz = 1.0 / direction.z
+                t = (.5 - origin.z) * inv_dz
+                self._dragScratch.set(
+                    origin.x + direction.x*t, origin.y + direction.y*t, .5)
+                pieces[dragging].obj.setPos(self._dragScratch)
+
+
+            # Highlight valid moves. They don't change during a drag, so this
+            # only needs doing on the first frame of it
+            if dragging >= 0 and self._dragMaskSrc != dragging:
+                mask = self._dragMask
+                valid = self._validNPC
                 for i in range(64):
-                    if self.isVaidMove(self.pieces[self.dragging], self.dragging, i):
-                        self.squares[i].setColor(VALID)
+                    if (mask >> i) & 1:
+                        valid.addPath(squares[i])
+                        dirty.add(i)
+                valid.setColor(*VALID)
+                self._dragMaskSrc = dragging
 
             # Do the actual collision pass (Do it only on the squares for
             # efficiency purposes)
@@ -303,36 +336,46 @@ class ChessboardDemo(ShowBase):
                 # if we have hit something, sort the hits so that the closest
                 # is first, and highlight that node
                 self.pq.sortEntries()
-                i = int(self.pq.getEntry(0).getIntoNode().getTag('square'))
+                i = self.pq.getEntry(0).getIntoNode().getPythonTag('square')
                 # Set the highlight on the picked square
-                self.squares[i].setColor(HIGHLIGHT)
+                squares[i].setColor(HIGHLIGHT)
                 self.hiSq = i
-                
 
-                
+            # Remember where this collision pass was done from
+            self._lastMpos = (mpos.getX(), mpos.getY())
+        else:
+            self._lastMpos = None
 
         return Task.cont
 
     def grabPiece(self):
         # If a square is highlighted and it has a piece, set it to dragging
         # mode
-        if self.hiSq is not False and self.pieces[self.hiSq]:
+        if self.hiSq >= 0 and self.pieces[self.hiSq]:
             self.dragging = self.hiSq
-            self.hiSq = False
+            self.squares[self.hiSq].setColor(_SQUARE_COLORS[self.hiSq])
+            self.hiSq = -1
+            # Make mouseTask paint the valid moves for this piece
+            self._dragMaskSrc = -1
+            # The legal moves can't change while the piece is being dragged
+            self._dragMask = self._legal_mask(
+                self.pieces[self.dragging], self.dragging)
 
     def releasePiece(self):
         # Letting go of a piece. If we are not on a square, return it to its original
         # position. Otherwise, swap it with the piece in the new square
         # Make sure we really are dragging something
-        if self.dragging is not False:
+        if self.dragging >= 0:
             # We have let go of the piece, but we are not on a square
-            if self.hiSq is False or self.isVaidMove(self.pieces[self.dragging], self.dragging, self.hiSq) is False or self.pieces[self.dragging].white != self.is_turn_white:
+            if self.hiSq < 0 or not (self._dragMask >> self.hiSq) & 1 or self.pieces[self.dragging].white != self.is_turn_white:
                 self.pieces[self.dragging].obj.setPos(
-                    SquarePos(self.dragging))
-                print(f"Moving a white={self.pieces[self.dragging].white} {type(self.pieces[self.dragging])} from {self.dragging} to {self.hiSq} is invalid!")
+                    _SQUARE_POS[self.dragging])
+                if self._debug:
+                    print(f"Moving a white={self.pieces[self.dragging].white} {type(self.pieces[self.dragging])} from {self.dragging} to {self.hiSq} is invalid!")
             else:
                 # Otherwise, swap the pieces
-                print(f"swapping {self.dragging} and {self.hiSq}")
+                if self._debug:
+                    print(f"swapping {self.dragging} and {self.hiSq}")
                 # sets first move to False
                 self.pieces[self.dragging].is_first_move = False
                 self.swapPieces(self.dragging, self.hiSq)
@@ -344,10 +387,19 @@ class ChessboardDemo(ShowBase):
                     camera.setPosHpr(0, -12, 8, 0, -35, 0)  # Set the camera to white side
                 else:
                     camera.setPosHpr(0, 12, 8, 180, -35, 0)  # Set the camera to black side
+                self._camMat = camera.getMat(render)
 
 
-        # We are no longer dragging anything
-        self.dragging = False
+        # We are no longer dragging anything, so take the valid moves off the board
+        for i in self._dirtySquares:
+            self.squares[i].setColor(_SQUARE_COLORS[i])
+        self._dirtySquares.clear()
+        self._validNPC.clear()
+        self._dragMaskSrc = -1
+        self.dragging = -1
+        # The squares were recolored and the camera may have moved, so the next
+        # frame needs a fresh collision pass
+        self._lastMpos = None
 
     def setupLights(self):  # This function sets up some default lighting
         ambientLight = AmbientLight("ambientLight")
@@ -362,21 +414,31 @@ class ChessboardDemo(ShowBase):
 # Class for a piece. This just handles loading the model and setting initial
 # position and color
 class Piece(object):
+    # Give every piece type its moves as an int8 array for the move generator
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.moves_arr = np.array(cls.moves, dtype=np.int8)
+
     def __init__(self, square, color):
         self.obj = loader.loadModel(self.model)
         self.obj.reparentTo(render)
         self.obj.setColor(color)
-        self.obj.setPos(SquarePos(square))
+        self.obj.setPos(_SQUARE_POS[square])
+        self.square = square
         self.white = True
         # if the color is PIECEBLACK, set white to false
         if color == PIECEBLACK:
             self.white = False
+        # What this piece looks like on the board the move generator uses
+        self.board_value = self.piece_id if self.white else -self.piece_id
+        base._board[square] = self.board_value
             
         # Checks if the piece has been moved
         self.is_first_move = False
     # Removes a piece
     def remove(self):
         self.obj.detachNode()
+        base._board[self.square] = 0
 
 
 # Classes for each type of chess piece
@@ -391,31 +453,37 @@ class Pawn(Piece):
     #else:
     #    moves = [(0,-1),(1,-1),(-1,-1)]
     limit = True
+    piece_id = 1
 
 class King(Piece):
     model = "models/king"
     moves = [(1,0),(0,1),(-1,0),(0,-1),(1,1),(-1,1),(1,-1),(-1,-1)]
     limit = True
+    piece_id = 6
 
 class Queen(Piece):
     model = "models/queen"
     moves = [(1,0),(0,1),(-1,0),(0,-1),(1,1),(-1,1),(1,-1),(-1,-1)]
     limit = False
+    piece_id = 5
 
 class Bishop(Piece):
     model = "models/bishop"
     moves = [(1,1),(-1,1),(1,-1),(-1,-1)]
     limit = False
+    piece_id = 3
 
 class Knight(Piece):
     model = "models/knight"
     moves = [(-1,2),(-2,1),(-2,-1),(-1,-2),(1,-2),(2,-1),(2,1),(1,2)]
     limit = True
+    piece_id = 2
 
 class Rook(Piece):
     model = "models/rook"
     moves = [(1,0),(0,1),(-1,0),(0,-1)]
     limit = False
+    piece_id = 4
 
 # Do the main initialization and start 3D rendering
 demo = ChessboardDemo()